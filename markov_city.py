@@ -1,6 +1,52 @@
 import numpy as np
 import math
 import bpy
+import bmesh
+from mathutils import Matrix
+
+# Numba isn't bundled with Blender's Python, so fall back to running the kernels as plain Python when it is missing
+try:
+    from numba import njit
+except ImportError:
+    def njit(function):
+        return function
+
+
+@njit
+def sample_alias(alias_probs, aliases, s, u):
+    """
+    Returns the index of the next state using the alias tables for the current state.
+    Args:
+        alias_probs (np.ndarray): 2D array of the probability of keeping each column for each state
+        aliases (np.ndarray): 2D array of the state to use instead of each column for each state
+        s (int): the index of the current state
+        u (float): a uniform random value in [0, 1)
+    """
+    # The integer part of the scaled value picks the column, and the fractional part decides between the column
+    # and its alias, so only one random value is needed per draw
+    x = u * aliases.shape[1]
+    column = int(x)
+    if x - column < alias_probs[s, column]:
+        return column
+    return aliases[s, column]
+
+
+@njit
+def simulate_chain(alias_probs, aliases, start, u, out):
+    """
+    Walks a Markov chain from the start state, writing the index of each visited state to out.
+    Args:
+        alias_probs (np.ndarray): 2D array of the probability of keeping each column for each state
+        aliases (np.ndarray): 2D array of the state to use instead of each column for each state
+        start (int): the index of the initial state
+        u (np.ndarray): uniform random values in [0, 1), one for each step of the walk
+        out (np.ndarray): array that the state index of each step is written to
+    """
+    s = start
+    for i in range(u.size):
+        s = sample_alias(alias_probs, aliases, s, u[i])
+        out[i] = s
+
 
 class MarkovCity:
     """
@@ -16,7 +62,7 @@ class MarkovCity:
     BASE_COLOR = (0.1, 0.1, 0.1, 1)
 
     
-    def __init__(self, height_transition_matrix, height_prior_vector, color_transition_matrix, color_prior_vector):
+    def __init__(self, height_transition_matrix, height_prior_vector, color_transition_matrix, color_prior_vector, seed = None):
         """
         Uses Markov models to generate a small-scale city in Blender. One model is used for a building's height and
         number of sides, and the other is used for determining the color of each building.
@@ -25,6 +71,8 @@ class MarkovCity:
             height_prior_vector (dict): the initial state vector for heights
             color_transition_matrix (dict): color transition probabilities for the Markov model
             color_prior_vector (dict): the initial state vector for color
+            seed (int): the seed for the random number generator so that the same city can be created again. If it is
+                None, a different city is created each time.
         """
         self.height_transition_matrix = height_transition_matrix
         self.height_prior_vector = height_prior_vector
@@ -33,6 +81,166 @@ class MarkovCity:
         self.color_transition_matrix = color_transition_matrix
         self.color_prior_vector = color_prior_vector
         self.colors = list(color_transition_matrix)
+        # Every random value is drawn from this one generator, which is faster than the legacy np.random functions
+        self.rng = np.random.default_rng(seed)
+        # Geometry and materials for the buildings that have been created but not yet added to the scene, keyed by their
+        # number of sides
+        self.building_meshes = {}
+        self.building_materials = {}
+        # Materials that have already been created, keyed by their RGBA value, so that buildings with the same
+        # appearance share one material. It is reset for each city since clear_city() leaves the old materials unused,
+        # and Blender may delete them.
+        self.material_cache = {}
+        # Unit-sized building geometry for each number of sides, see get_building_prototype()
+        self.building_prototypes = {}
+
+        # Store the probabilities as arrays that are indexed by the position of each state in self.heights or self.colors
+        # so that sampling doesn't need any dictionary lookups
+        self.heights_arr = np.asarray(self.heights)
+        self.height_index = {height: i for i, height in enumerate(self.heights)}
+        self.height_transition_probs = MarkovCity.get_transition_probs(height_transition_matrix, self.heights)
+        self.height_prior_probs = np.asarray([height_prior_vector[height] for height in self.heights], dtype = np.float64)
+        self.height_prior_cdf = MarkovCity.get_cdf(self.height_prior_probs)
+        self.colors_arr = np.asarray(self.colors, dtype = np.float64)
+        self.color_index = {color: i for i, color in enumerate(self.colors)}
+        self.color_transition_probs = MarkovCity.get_transition_probs(color_transition_matrix, self.colors)
+        self.color_prior_probs = np.asarray([color_prior_vector[color] for color in self.colors], dtype = np.float64)
+        self.color_prior_cdf = MarkovCity.get_cdf(self.color_prior_probs)
+
+        # Precompute alias tables for each row of the transition matrices so that sampling the next state takes
+        # constant time instead of a call to np.random.choice, which rebuilds and validates the probabilities every time.
+        self.height_alias_probs, self.height_aliases = MarkovCity.get_alias_tables(self.height_transition_probs)
+        self.color_alias_probs, self.color_aliases = MarkovCity.get_alias_tables(self.color_transition_probs)
+
+        # Alias tables for drawing every building independently from the stationary distribution of each chain. They are
+        # only built the first time they are needed, see get_stationary_alias_tables().
+        self.stationary_alias_tables = None
+
+        # When every row of a transition matrix is the same, the next state doesn't depend on the current one, so the
+        # whole chain can be sampled at once instead of one step at a time. The rows must be exactly equal, otherwise
+        # sampling only from the first row would change the model.
+        self.height_is_iid = (self.height_transition_probs == self.height_transition_probs[0]).all()
+        self.color_is_iid = (self.color_transition_probs == self.color_transition_probs[0]).all()
+
+
+    @staticmethod
+    def get_transition_probs(transition_matrix, states):
+        """
+        Returns the transition matrix as a 2D array where entry [i, j] is the probability of moving from states[i] to states[j].
+        Args:
+            transition_matrix (dict): the transition probabilities for the Markov model
+            states (list): the states of the Markov model in the order the rows and columns should have
+        """
+        return np.asarray([[transition_matrix[i][j] for j in states] for i in states], dtype = np.float64)
+
+
+    @staticmethod
+    def get_cdf(probs):
+        """
+        Returns the cumulative distribution of a probability vector.
+        Args:
+            probs (np.ndarray): 1D array of probabilities that sum to 1
+        """
+        cdf = np.cumsum(probs)
+        # Guard against rounding errors so that a random value in [0, 1) always falls within the last bin
+        cdf[-1] = 1
+        return cdf
+
+
+    @staticmethod
+    def get_stationary_probs(transition_probs):
+        """
+        Returns the stationary distribution of the Markov chain, which is the probability vector pi where
+        pi @ transition_probs == pi. It is the long-run fraction of steps that the walk spends in each state.
+        Args:
+            transition_probs (np.ndarray): 2D array of the transition probabilities for the Markov model
+        """
+        num_states = transition_probs.shape[0]
+        balance = transition_probs.T - np.eye(num_states)
+        # A chain that can get stuck in more than one group of states has a stationary distribution for each group, so
+        # there is no single distribution to draw from. In that case the balance equations have more than one
+        # independent solution. The tolerance is absolute since probabilities are always on the same scale, which keeps
+        # chains that only rarely change state from looking like they get stuck.
+        if np.linalg.matrix_rank(balance, tol = 1e-10) != num_states - 1:
+            raise ValueError('The Markov model does not have a unique stationary distribution')
+
+        # Solve the balance equations together with the requirement that the probabilities sum to 1
+        equations = np.vstack([balance, np.ones(num_states)])
+        targets = np.zeros(num_states + 1)
+        targets[-1] = 1
+        stationary_probs = np.linalg.lstsq(equations, targets, rcond = None)[0]
+        # The unique stationary distribution has no negative values, so anything below 0 is only a rounding error
+        return np.clip(stationary_probs, 0, None)
+
+
+    def get_stationary_alias_tables(self):
+        """
+        Returns the alias tables for the stationary distributions of the height and color Markov models as a pair of
+        (alias_probs, aliases) tuples. They are computed on the first call and reused afterwards.
+        """
+        if self.stationary_alias_tables is None:
+            self.stationary_alias_tables = (
+                MarkovCity.get_alias_tables(MarkovCity.get_stationary_probs(self.height_transition_probs)[np.newaxis]), 
+                MarkovCity.get_alias_tables(MarkovCity.get_stationary_probs(self.color_transition_probs)[np.newaxis])
+            )
+
+        return self.stationary_alias_tables
+
+
+    @staticmethod
+    def get_alias_tables(transition_probs):
+        """
+        Builds the tables for sampling each row of the transition matrix with Vose's alias method. Returns a 2D array
+        with the probability of keeping each column and a 2D array with the index of the state to use otherwise.
+        Args:
+            transition_probs (np.ndarray): 2D array where each row is a probability distribution over the states
+        """
+        num_rows, num_states = transition_probs.shape
+        # Columns default to keeping themselves with a probability of 1. Any column that is left over once the pairing
+        # below finishes is only off from 1 because of rounding errors, so it keeps these defaults.
+        alias_probs = np.ones((num_rows, num_states), dtype = np.float64)
+        aliases = np.tile(np.arange(num_states), (num_rows, 1))
+
+        for row in range(num_rows):
+            scaled_probs = (transition_probs[row] * num_states).tolist()
+            small = [i for i, p in enumerate(scaled_probs) if p < 1]
+            large = [i for i, p in enumerate(scaled_probs) if p >= 1]
+
+            # Pair each column that is under-full with one that is over-full and move the excess into it
+            while small and large:
+                less = small.pop()
+                more = large.pop()
+                alias_probs[row, less] = scaled_probs[less]
+                aliases[row, less] = more
+                scaled_probs[more] += scaled_probs[less] - 1
+                if scaled_probs[more] < 1:
+                    small.append(more)
+                else:
+                    large.append(more)
+
+        return alias_probs, aliases
+
+
+    @staticmethod
+    def get_state_indices(alias_probs, aliases, is_iid, start, random_values):
+        """
+        Returns the index of each state visited by a walk of the Markov chain.
+        Args:
+            alias_probs (np.ndarray): 2D array of the probability of keeping each column for each state
+            aliases (np.ndarray): 2D array of the state to use instead of each column for each state
+            is_iid (bool): whether every row of the transition matrix is the same
+            start (int): the index of the initial state
+            random_values (np.ndarray): uniform random values in [0, 1), one for each step of the walk
+        """
+        if is_iid:
+            # Every step uses the first row's alias tables, so sample them all at once the same way sample_alias does
+            x = random_values * aliases.shape[1]
+            columns = x.astype(np.int64)
+            return np.where(x - columns < alias_probs[0, columns], columns, aliases[0, columns])
+
+        state_indices = np.empty(random_values.size, dtype = np.int64)
+        simulate_chain(alias_probs, aliases, start, random_values, state_indices)
+        return state_indices
 
 
     def get_next_height(self, current_height):
@@ -41,10 +249,8 @@ class MarkovCity:
         Args:
             current_height (float): the height of the current building
         """
-        return np.random.choice(
-            self.heights, 
-            p = [self.height_transition_matrix[current_height][next_height] for next_height in self.heights] 
-        )
+        index = sample_alias(self.height_alias_probs, self.height_aliases, self.height_index[current_height], self.rng.random())
+        return self.heights_arr[index]
 
     
     def get_next_color(self, current_color):
@@ -53,100 +259,154 @@ class MarkovCity:
         Args:
             current_color (tuple(float, float, float)): the RGB value of the current color where each value is in the range [0, 1]
         """
-        # Select the index of the color that should be returned since numpy expects the first argument to be a 1D array, and it is
-        # not in this case.
-        index = np.random.choice(
-            range(len(self.colors)), 
-            p = [self.color_transition_matrix[current_color][next_color] for next_color in self.colors] 
-        )
+        # Select the index of the color that should be returned since the colors can't be stored in a 1D array
+        index = sample_alias(self.color_alias_probs, self.color_aliases, self.color_index[current_color], self.rng.random())
         return self.colors[index]
 
 
-    def get_building_info(self, num_rows, num_cols):
+    def get_building_info(self, num_rows, num_cols, stationary = False):
         """
-        Returns a 2D array containing the heights and color for each building in the grid.
+        Returns a 2D array containing the height of each building in the grid and a 3D array containing the RGB value of
+        each building's color.
         Args:
             num_rows (int): the number of rows in the grid
             num_cols (int): the number of columns in the grid
+            stationary (bool): whether to draw each building independently from the stationary distributions instead
+                of walking the Markov chains
         """
-        building_info = [[None] * num_cols for r in range(num_rows)]
+        num_buildings = num_rows * num_cols
 
-        # Get initial height and color
-        current_height = np.random.choice(
-            self.heights, 
-            p = [self.height_prior_vector[next_height] for next_height in self.heights] 
-        )
-        current_color_index = np.random.choice(
-            range(len(self.colors)), 
-            p = [self.color_prior_vector[next_color] for next_color in self.colors] 
-        )
-        current_color = self.colors[current_color_index]
+        # Draw all of the random values that are needed for both chains up front with a single call rather than
+        # separately for each building's height and color. The first value of each chain is used for its initial state.
+        random_values = self.rng.random((2, num_buildings + 1))
+        height_start_value, color_start_value = random_values[:, 0]
+        height_random_values, color_random_values = random_values[:, 1:]
 
-        for row in range(num_rows):
-            for col in range(num_cols):
-                next_height = self.get_next_height(current_height)
-                next_color = self.get_next_color(current_color)
-                building_info[row][col] = (next_height, next_color)
-                current_height = next_height
-                current_color = next_color
+        if stationary:
+            (height_alias_probs, height_aliases), (color_alias_probs, color_aliases) = self.get_stationary_alias_tables()
+            height_indices = MarkovCity.get_state_indices(
+                height_alias_probs, height_aliases, True, 0, height_random_values
+            ).reshape((num_rows, num_cols))
+            color_indices = MarkovCity.get_state_indices(
+                color_alias_probs, color_aliases, True, 0, color_random_values
+            ).reshape((num_rows, num_cols))
+            return self.heights_arr[height_indices], self.colors_arr[color_indices]
+
+        # Get initial height and color. There are only a few states, so counting how many values of the prior's CDF the
+        # random value has passed is faster than a binary search and doesn't branch. Counting values <= the random value
+        # skips over any states that have a probability of 0.
+        current_height_index = np.count_nonzero(self.height_prior_cdf <= height_start_value)
+        current_color_index = np.count_nonzero(self.color_prior_cdf <= color_start_value)
+
+        # Walk both chains, then look up the height and color for each visited state
+        height_indices = MarkovCity.get_state_indices(
+            self.height_alias_probs, self.height_aliases, self.height_is_iid, current_height_index, height_random_values
+        ).reshape((num_rows, num_cols))
+        color_indices = MarkovCity.get_state_indices(
+            self.color_alias_probs, self.color_aliases, self.color_is_iid, current_color_index, color_random_values
+        ).reshape((num_rows, num_cols))
 
-        return building_info
+        return self.heights_arr[height_indices], self.colors_arr[color_indices]
 
     
     def clear_city(self):
         """
         Removes the current city from the scene.
         """
-        # Prevents an exception from being thrown if there are no active objects in the scene when clearing it
-        try:
-            bpy.ops.object.mode_set(mode = 'OBJECT')
-        except:
-            pass
-
         skip_delete_objects = set(['CAMERA', 'LIGHT'])
 
-        # Delete all objects in the scene that aren't cameras or lights
-        for o in bpy.context.scene.objects:
-            if o.type in skip_delete_objects:
-                o.select_set(False)
-            else:
-                o.select_set(True)
-
-        bpy.ops.object.delete() 
+        # Delete all objects in the scene that aren't cameras or lights. Removing them through bpy.data avoids the
+        # selection changes and scene update that bpy.ops.object.delete() causes.
+        for o in [o for o in bpy.context.scene.objects if o.type not in skip_delete_objects]:
+            bpy.data.objects.remove(o, do_unlink = True)
 
 
     def add_building(self, x, y, radius, number_of_sides, height, color):
         """
-        Adds a building the specified coordinates based on the parameter values.
+        Queues a building at the specified coordinates based on the parameter values. The building isn't added to the
+        scene until link_buildings() is called, which create_city() does after adding every building.
         Args:
             x (float):  the x value for where the building should be created in the scene
             y (float): the y value for where the building should be created in the scene
             radius (float): the radius of the building
             number_of_sides (int): the number of sides on the top and bottom faces of the building
             height (float): the height of the building
-            color (tuple(float, float, float)): the color of the building as an RGB value
-        """
-        # Create the building
-        bpy.ops.mesh.primitive_cylinder_add(
-            location = (x, y, height / 2), 
-            vertices = number_of_sides, 
-            radius = radius, 
-            depth = height, 
-            # Rotating by pi / 4 causes the rectangular buildings to line up with the grid
-            rotation = (0, 0, math.pi / 4) 
-        )
+            color (tuple(float, float, float, float)): the color of the building as an RGBA value
+        """
+        # Buildings with the same number of sides are added to the same mesh so that they can all be added to the scene
+        # at once by link_buildings() instead of updating the scene for every building
+        if number_of_sides not in self.building_meshes:
+            self.building_meshes[number_of_sides] = {'vertices': [], 'faces': [], 'material_indices': [], 'num_vertices': 0}
+            self.building_materials[number_of_sides] = {}
+        building_mesh = self.building_meshes[number_of_sides]
+        building_materials = self.building_materials[number_of_sides]
+
+        # Create the building by scaling and moving a copy of the prototype for its number of sides
+        prototype_vertices, prototype_faces = self.get_building_prototype(number_of_sides)
+        offset = building_mesh['num_vertices']
+        building_mesh['vertices'].append(prototype_vertices * (radius, radius, height) + (x, y, height / 2))
+        building_mesh['faces'].extend(tuple(i + offset for i in face) for face in prototype_faces)
+        building_mesh['num_vertices'] += len(prototype_vertices)
         
-        # Create and assign new material for current building to set color
-        red_value, green_value, blue_value = color
-        mat = bpy.data.materials.new('Material' + str(len(bpy.data.materials) + 1))
-        # Color value influences how dark or light the color is. A larger color value corresponds to a darker color.
-        # Use number_of_sides to get the non-scaled height 
-        color_value = number_of_sides / (self.max_height * MarkovCity.HEIGHT_FACTOR_FOR_COLOR_SHADE)
-        mat.diffuse_color = (red_value - color_value, green_value - color_value, blue_value - color_value, 1)    
-        bpy.context.object.data.materials.append(mat)
+        # Assign a material for current building to set color, creating a new one if no other building has used it yet
+        if color not in self.material_cache:
+            mat = bpy.data.materials.new('Material' + str(len(bpy.data.materials) + 1))
+            mat.diffuse_color = color
+            self.material_cache[color] = mat
+        if color not in building_materials:
+            building_materials[color] = len(building_materials)
+        building_mesh['material_indices'].extend([building_materials[color]] * len(prototype_faces))
 
 
-    def create_city(self, base_size, cell_width = 10, height_scale_factor = 2.5):
+    def get_building_prototype(self, number_of_sides):
+        """
+        Returns the vertices and faces of a building centered on the origin with a radius and height of 1. The prototype for
+        each number of sides is only created once and then reused for every building with that many sides.
+        Args:
+            number_of_sides (int): the number of sides on the top and bottom faces of the building
+        """
+        if number_of_sides not in self.building_prototypes:
+            prototype = bmesh.new()
+            # Rotating by pi / 4 causes the rectangular buildings to line up with the grid
+            bmesh.ops.create_cone(
+                prototype, 
+                cap_ends = True, 
+                # Buildings need at least 3 sides, which matches how primitive_cylinder_add clamps its vertices
+                segments = max(int(number_of_sides), 3), 
+                radius1 = 1, 
+                radius2 = 1, 
+                depth = 1, 
+                matrix = Matrix.Rotation(math.pi / 4, 4, 'Z')
+            )
+            prototype.verts.index_update()
+            self.building_prototypes[number_of_sides] = (
+                np.array([vert.co[:] for vert in prototype.verts]), 
+                [tuple(vert.index for vert in face.verts) for face in prototype.faces]
+            )
+            prototype.free()
+
+        return self.building_prototypes[number_of_sides]
+
+
+    def link_buildings(self):
+        """
+        Adds the buildings created by add_building() to the scene with one object for each number of sides.
+        """
+        for number_of_sides, building_mesh in self.building_meshes.items():
+            mesh = bpy.data.meshes.new('Buildings' + str(number_of_sides))
+            mesh.from_pydata(np.concatenate(building_mesh['vertices']).tolist(), [], building_mesh['faces'])
+            # Material slots are added in the order that their indices were given out in add_building()
+            for color in self.building_materials[number_of_sides]:
+                mesh.materials.append(self.material_cache[color])
+            mesh.polygons.foreach_set('material_index', building_mesh['material_indices'])
+            mesh.update()
+            bpy.context.collection.objects.link(bpy.data.objects.new(mesh.name, mesh))
+
+        self.building_meshes = {}
+        self.building_materials = {}
+
+
+    def create_city(self, base_size, cell_width = 10, height_scale_factor = 2.5, stationary = False):
         """
         Creates a city in Blender where the heights are based off of the transition matrix. Each cell contains
         a building, and there are floor(base_size / cell_width) by floor(base_size / cell_width) buildings in the city.
@@ -154,28 +414,36 @@ class MarkovCity:
             base_size (float): the width (and height) of the square city base
             cell_width (float): the width of each square cell within the grid
             height_scale_factor (float): the factor each building height will be scaled by
+            stationary (bool): whether to draw each building independently from the stationary distributions instead
+                of walking the Markov chains
         """
         self.clear_city()
+        self.material_cache = {}
 
         num_rows = int(base_size / cell_width)
         building_padding = cell_width / MarkovCity.PADDING_FACTOR
         displacement = base_size / 2 - (cell_width / 2)    
-        building_info = self.get_building_info(num_rows, num_rows)
-        
-        for row in range(num_rows):
-            for col in range(num_rows):
-                current_height, current_color = building_info[row][col]
-        
-                # If current_height <= 0, don't place a building in this cell
-                if current_height <= 0:
-                    continue
-
-                scaled_height = current_height * height_scale_factor
-                x_coord = row * cell_width - displacement
-                y_coord = col * cell_width - displacement
-                current_radius = cell_width / 2 - building_padding
-                # Create the building. Pass in current_height to be used as the building's number of sides
-                self.add_building(x_coord, y_coord, current_radius, current_height, scaled_height, current_color)
+        heights, colors = self.get_building_info(num_rows, num_rows, stationary)
+
+        # Compute the position, size, and color of every building at once before adding them to the scene. If a cell's
+        # height is <= 0, don't place a building in it.
+        rows, cols = np.nonzero(heights > 0)
+        # Use the heights as each building's number of sides
+        sides = heights[rows, cols]
+        scaled_heights = sides * height_scale_factor
+        x_coords = rows * cell_width - displacement
+        y_coords = cols * cell_width - displacement
+        radius = cell_width / 2 - building_padding
+        # Color value influences how dark or light the color is. A larger color value corresponds to a darker color.
+        # Use the number of sides to get the non-scaled height.
+        color_values = sides / (self.max_height * MarkovCity.HEIGHT_FACTOR_FOR_COLOR_SHADE)
+        rgbas = np.ones((sides.size, 4))
+        rgbas[:, :3] = colors[rows, cols] - color_values[:, np.newaxis]
+
+        for i in range(sides.size):
+            self.add_building(x_coords[i], y_coords[i], radius, sides[i], scaled_heights[i], tuple(rgbas[i].tolist()))
+
+        self.link_buildings()
 
         # Create the base and add color to it
         bpy.ops.mesh.primitive_plane_add(size = base_size, location = (0, 0, 0))